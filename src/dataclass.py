@@ -77,6 +77,11 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         self.combine_assignments = False  # Needs more memory but it's faster
         self.shuffle_buffer = 256
         self.interleaved_datasets = 256
+        self.parse_batch_size = 256
+        self.records_in_flight = 4096  # upper bound of parsed records held by all files of one interleave
+        self.byte_tokenization = False  # Raw UTF-8 bytes instead of unicode code points for text-tfrecords
+        self.cache_path = None  # None disables caching of decoded tokens, "" caches in memory, else a file prefix
+        # (suffixed per dataset and slice). gpt_neo_input only caches with use_random_dataloader, as it reads once.
         self.token_patch_size = 1
         self.learning_rate = 5e-5
         self.storage_dtype = "float32"
@@ -84,6 +89,7 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         self.calculation_dtype = "float32"
         self.optimizer_slice_dtype = "float32"
         self.optimizer_calculation_dtype = "float32"
+        self.bfloat16_softmax = False  # Exponentiate attention logits in bfloat16, accumulate in float32
         self.learning_rate_config = {}
         self.train_batch_size = 1
         self.grad_accumulation = 1
@@ -145,6 +151,8 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         self.use_bit_fold_input_pipeline = False
         self.bit_fold_value = 4
         self.debug_train_step = False
+        self.summary_flush_millis = 60_000
+        self.summary_max_queue = 1_000
         self.model_mode = 'jannet'
         self.optimizer = 'learning_rate'
         self.multi_loss_strategy = "linear"
@@ -339,6 +347,7 @@ class ModelParameter(typing.Dict[str, typing.Any]):
         self.attention_idx = 0
         self.variable_cache = {}
         self.cached_parameters = {}
+        self.constant_cache = {}
         self.debug_outfeed = {}
 
     def __getitem__(self, key: str) -> typing.Any:
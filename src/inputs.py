@@ -1,7 +1,8 @@
 """
 Contains input pipeline code that generates tensorflow datasets if called
 """
-import random
+import functools
+import hashlib
 
 import numpy as np
 import tensorflow as tf2
@@ -11,14 +12,58 @@ from .dataclass import ModelParameter, align_tensor_op
 tf = tf2.compat.v1
 Dataset = tf2.data.Dataset
 
+_TEXT_BYTES_FEATURES = {'text': tf.FixedLenFeature([], tf.string)}
+_TEXT_INT_FEATURES = {'text': tf.io.RaggedFeature(tf.int64)}
+
+
+def _tune(data: Dataset, params: ModelParameter) -> Dataset:
+    """
+    Attaches static tf.data optimizations to a dataset.
+    Element order is only relaxed for the random dataloader, as resuming a run (see simulate_data_pipeline) relies
+    on a deterministic order.
+    :param data: dataset to optimize
+    :param params: ModelParameter
+    :return: dataset with options
+    """
+    options = tf.data.Options()
+    options.experimental_deterministic = not params.use_random_dataloader
+    options.experimental_optimization.map_parallelization = True
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.map_fusion = True
+    options.experimental_optimization.parallel_batch = True
+    return data.with_options(options)
+
+
+def _cache_file(params: ModelParameter, *key) -> str:
+    """
+    Derives the cache location of one pipeline. Every dataset and every slice gets its own file prefix, so no two
+    pipelines ever read or lock a cache written by another one.
+    :param params: ModelParameter
+    :param key: everything that changes the cached elements, such as paths, slice index and context size
+    :return: argument for Dataset.cache
+    """
+    if not params.cache_path:  # in-memory caches are private to their pipeline already
+        return params.cache_path
+    return f"{params.cache_path}_{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}"
+
+
+def _parse_batch_size(params: ModelParameter, cycle_length: int) -> int:
+    """
+    Shrinks the parse batches of an interleave so that all of its open files together hold at most
+    params.records_in_flight decoded records.
+    :param params: ModelParameter
+    :param cycle_length: number of files the interleave reads from concurrently
+    :return: number of records to parse at once per file
+    """
+    return max(1, min(params.parse_batch_size, params.records_in_flight // cycle_length))
+
 
 def split_files(filenames, slice_index, slice_count, seed, runs_log=None):
     if not filenames:
         raise ValueError
     files = sorted(filenames)
     if seed != 0:
-        random.seed(seed)
-        random.shuffle(files)
+        files = [files[i] for i in np.random.default_rng(seed).permutation(len(files))]
 
     element_skip = [0] * len(files)
 
@@ -73,7 +118,9 @@ def simulate_data_pipeline(runs_log, file_list):
                     # Take from interleave until all TF-records in interleave batch are emty
                     # or until step_stop_count is done.
                     inter_idx = 0
-                    while sum(interleave_chunk) > 0 and _step_stop_count > 0:
+                    # Running total of the remaining elements, so the loop doesn't re-sum the chunk every step.
+                    remaining = sum(interleave_chunk)
+                    while remaining > 0 and _step_stop_count > 0:
 
                         # Jump the interleave sample pos to a non depleted TF-record.
                         while interleave_chunk[inter_idx] <= 0:
@@ -84,6 +131,7 @@ def simulate_data_pipeline(runs_log, file_list):
 
                         # Remove n ctx elements from the TF-record.
                         interleave_chunk[inter_idx] = interleave_chunk[inter_idx] - ctx
+                        remaining -= ctx
                         _step_stop_count -= 1
 
                         inter_idx += 1
@@ -128,6 +176,23 @@ def simulate_data_pipeline(runs_log, file_list):
     return file_list_skip, element_skip
 
 
+@functools.lru_cache(maxsize=None)
+def _video_features(language_token_num_per_frame: int):
+    features = {
+            'frame':      tf.FixedLenFeature([], tf.string),
+            'concat':     tf.FixedLenFeature([], tf.int64),
+            'skip_frame': tf.FixedLenFeature([], tf.int64)
+            }
+
+    if language_token_num_per_frame > 0:
+        features.update({
+                'tokens': tf.FixedLenFeature([language_token_num_per_frame], tf.int64),
+                'mask':   tf.FixedLenFeature([], tf.int64)
+                })
+
+    return features
+
+
 def get_video_decoder(params, language_token_num_per_frame=0, frame_height=None, frame_width=None, color_channels=None,
                       color_quantization_value=256):
     '''
@@ -137,24 +202,15 @@ def get_video_decoder(params, language_token_num_per_frame=0, frame_height=None,
     :param frame_width:
     :param color_channels:
 
-    This function will return a frame decoder function, that can than be used to decode tf.records.
+    This function will return a batched proto parser and a frame decoder function, that can than be used to decode
+    tf.records. The parser works on batches of serialized protos, the decoder on single (unbatched) parsed samples.
     '''
 
     decode_language_token = language_token_num_per_frame > 0
-    token_range = tf.range(0, language_token_num_per_frame)
+    token_range = tf.range(0, language_token_num_per_frame) if decode_language_token else None
 
     # Decoding Key.
-    features = {
-            'frame':      tf.FixedLenFeature([], tf.string),
-            'concat':     tf.FixedLenFeature([], tf.int64),
-            'skip_frame': tf.FixedLenFeature([], tf.int64)
-            }
-
-    if decode_language_token:
-        features.update({
-                'tokens': tf.FixedLenFeature([language_token_num_per_frame], tf.int64),
-                'mask':   tf.FixedLenFeature([], tf.int64)
-                })
+    features = _video_features(language_token_num_per_frame)
 
     three_axes = params.three_axes
 
@@ -174,6 +230,8 @@ def get_video_decoder(params, language_token_num_per_frame=0, frame_height=None,
     if params.use_bit_fold_input_pipeline:
         out_frame_shape.insert(-1, params.fold_count)
 
+    frame_dtype = tf.uint32 if params.use_bit_fold_input_pipeline else tf.uint8
+
     multi = [1]
     for _ in range(params.fold_count - 1):
         multi.append(multi[-1] * (2 ** params.bit_fold_value))
@@ -197,23 +255,29 @@ def get_video_decoder(params, language_token_num_per_frame=0, frame_height=None,
 
         return frame
 
-    def frame_decoder(proto):
+    def frame_parser(protos):
+        '''
+        :param protos: Batch of proto buffers to be parsed.
+        :return: dict of batched features.
+        '''
+
+        return tf.io.parse_example(protos, features)
+
+    def frame_decoder(sample):
         '''
-        :param proto: Proto buffer to be decoded.
+        :param sample: Parsed proto buffer to be decoded.
         :return: tensor with decode frame.
 
-        This Function will decode frame from proto buffer.
+        This Function will decode frame from a parsed proto buffer.
         '''
 
-        sample = tf.parse_single_example(proto, features)
         concat = sample['concat']
         skip_frame = sample['skip_frame']
 
-        if skip_frame > 0 or concat > 0:
-            frame = tf.zeros(shape=frame_shape, dtype=(tf.uint32 if params.use_bit_fold_input_pipeline else tf.uint8))
-        else:
-            frame = tf.image.decode_image(sample['frame'])
-            frame = op_decod(frame)
+        # tf.cond ensures that skipped and concatenated frames never reach the image decoder.
+        frame = tf.cond(tf.logical_or(skip_frame > 0, concat > 0),
+                        lambda: tf.zeros(shape=frame_shape, dtype=frame_dtype),
+                        lambda: op_decod(tf.image.decode_image(sample['frame'])))
 
         if decode_language_token:
             tokens = sample['tokens']
@@ -225,46 +289,59 @@ def get_video_decoder(params, language_token_num_per_frame=0, frame_height=None,
 
         return frame, concat, skip_frame
 
-    return tf.function(frame_decoder)
+    return tf.function(frame_parser), tf.function(frame_decoder)
 
 
 def _text_decoder(decoder, data: tf.Tensor, ctx: int, patch_size: int, chunk_size: int,
-                  shuffle_buffer: int = 0, _skip=None):
+                  shuffle_buffer: int = 0, _skip=None, parse_batch_size: int = 256):
     """
     Read a given tfrecord and windowed text dataset out of it.
     :param data: protobuf object to decode
     :param ctx: context size of generated dataset
     :param chunk_size: batch size directly after creating the dataset
+    :param parse_batch_size: number of protobuf records parsed at once by the decoder
     :return: tensorflow dataset of token
     """
 
-    def chunk(tfrecorddataset):
-        data = decoder(tfrecorddataset)
+    def chunk(tokens):
         if _skip is not None:
-            data = data.skip(tf.cast(_skip, dtype=tf.int64))
+            tokens = tokens[tf.cast(_skip, dtype=tf.int32):]
         if chunk_size > 0:
-            data = data.batch(chunk_size)
-        data = data.window(size=ctx + patch_size, shift=ctx, stride=1, drop_remainder=True)
-        data = data.interleave(lambda x: x.batch(ctx + patch_size, drop_remainder=True), cycle_length=1)
-        return data
+            tokens = tokens[:tf.shape(tokens)[0] // chunk_size * chunk_size]
+            tokens = tf.reshape(tokens, tf.concat([[-1, chunk_size], tf.shape(tokens)[1:]], axis=0))
+        return tf.signal.frame(tokens, frame_length=ctx + patch_size, frame_step=ctx, axis=0)
 
-    return tf.data.TFRecordDataset(filenames=data).interleave(chunk, cycle_length=1)
+    data = tf.data.TFRecordDataset(filenames=data).batch(parse_batch_size)
+    data = data.map(decoder, num_parallel_calls=tf2.data.AUTOTUNE).unbatch()
+    return data.map(chunk, num_parallel_calls=tf2.data.AUTOTUNE).unbatch()
 
 
 @tf.function
 def decode_bytestring(proto):
-    text_slice = tf.parse_single_example(proto, {'text': tf.FixedLenFeature([], tf.string)})['text']
-    data = tf.data.Dataset.from_tensor_slices(tf.reshape(tf.strings.unicode_decode(text_slice, 'UTF-8'), (-1, 1)))
-    return data
+    text_slice = tf.io.parse_example(proto, _TEXT_BYTES_FEATURES)['text']
+    text_slice = tf.strings.unicode_decode(text_slice, 'UTF-8')
+    return text_slice.with_flat_values(tf.reshape(text_slice.flat_values, (-1, 1)))
+
+
+@tf.function
+def decode_rawbytestring(proto):
+    text_slice = tf.io.parse_example(proto, _TEXT_BYTES_FEATURES)['text']
+    tokens = tf.io.decode_raw(tf.strings.reduce_join(text_slice), tf.uint8)
+    tokens = tf.reshape(tf.cast(tokens, tf.int32), (-1, 1))
+    return tf.RaggedTensor.from_row_lengths(tokens, tf.strings.length(text_slice))
+
+
+def get_text_decoder(params: ModelParameter, filename: str):
+    if 'int64' in filename:
+        return decode_intstring
+    return decode_rawbytestring if params.byte_tokenization else decode_bytestring
 
 
 @tf.function
 def decode_intstring(proto):
-    x = tf.parse_single_example(proto, {'text': tf.VarLenFeature(tf.int64)})
+    x = tf.io.parse_example(proto, _TEXT_INT_FEATURES)
     x = x['text']
-    x = tf.sparse.to_dense(x)
     x = tf.cast(x, tf.int32)
-    x = tf.data.Dataset.from_tensor_slices(x)
     return x
 
 
@@ -318,6 +395,9 @@ def dataset_text(path: str, params: ModelParameter, sub_batch_size: int, slice_i
 
         x = tf.reshape(x, (sub_batch_size, time_patch_size + 1, language_token_patch, token_patch_size))
 
+        if not params.use_bit_fold_input_pipeline:
+            _padding_frame = tf.cast(_padding_frame, tf.int32)
+
         token_x = x[:, :time_patch_size]
         token_y = x[:, 1:time_patch_size + 1]
 
@@ -347,24 +427,34 @@ def dataset_text(path: str, params: ModelParameter, sub_batch_size: int, slice_i
 
     filenames = tf.io.gfile.glob(path)
     data, _ = split_files(filenames, slice_index, slice_count, params.data_seed * params.shuffle_input_filenames)
-    decoder = decode_intstring if 'int64' in data[0] else decode_bytestring
-    print('decode_intstring' if 'int64' in data[0] else 'decode_bytestring', data[0], len(data))
+    decoder = get_text_decoder(params, data[0])
+    print(decoder.__name__, data[0], len(data))
 
     data = tf.data.Dataset.from_tensor_slices(data)
-    data = data.repeat()
+    if params.cache_path is None:
+        data = data.repeat()
 
     data = data.interleave(lambda x: _text_decoder(decoder=decoder,
                                                    data=x,
                                                    ctx=time_patch_size * (language_token_per_frame - 1),
                                                    patch_size=language_token_per_frame - 1,
-                                                   chunk_size=-1))
+                                                   chunk_size=-1,
+                                                   parse_batch_size=_parse_batch_size(params,
+                                                                                      params.interleaved_datasets)),
+                           cycle_length=params.interleaved_datasets,
+                           num_parallel_calls=tf2.data.AUTOTUNE)
+    if params.cache_path is not None:
+        # The cache has to be filled by a finite dataset, so repeat only afterwards.
+        ctx = time_patch_size * (language_token_per_frame - 1)
+        data = data.cache(_cache_file(params, path, slice_index, slice_count, ctx)).repeat()
 
     data = data.shuffle(params.shuffle_buffer, seed=(params.data_seed if not params.use_random_dataloader else None))
     data = tf.data.Dataset.zip((data, padding_token, padding_frame, padding_frame_mask, padding_cat_mask))
     data = data.batch(sub_batch_size)
     data = data.map(_memory_func, num_parallel_calls=tf2.data.AUTOTUNE)
+    data = data.prefetch(tf2.data.AUTOTUNE)
 
-    return data
+    return _tune(data, params)
 
 
 def dataset_video(path: str, params: ModelParameter, sub_batch_size: int, slice_index, slice_count):
@@ -395,12 +485,16 @@ def dataset_video(path: str, params: ModelParameter, sub_batch_size: int, slice_
     assert not (language_token_per_frame > 0 and time_patch > 1), \
         ("Time patch and language token are currently not supported together")
 
+    parse_batch_size = _parse_batch_size(params, params.interleaved_datasets)
+
     def _decode_func(name: tf.Tensor):
-        data = tf.data.TFRecordDataset(filenames=tf.convert_to_tensor(name), buffer_size=2 ** 26, num_parallel_reads=1)
-        data = data.map(frame_decoder, num_parallel_calls=1)
+        data = tf.data.TFRecordDataset(filenames=tf.convert_to_tensor(name), buffer_size=2 ** 26)
+        data = data.batch(parse_batch_size)
+        data = data.map(frame_parser, num_parallel_calls=tf2.data.AUTOTUNE).unbatch()
+        data = data.map(frame_decoder, num_parallel_calls=tf2.data.AUTOTUNE)
 
         data = data.window(size=sequence_length + time_patch, stride=1, shift=sequence_length, drop_remainder=True)
-        data = data.interleave(interleave_func, cycle_length=1, num_parallel_calls=1, block_length=1)
+        data = data.interleave(interleave_func, cycle_length=1, num_parallel_calls=tf2.data.AUTOTUNE, block_length=1)
 
         return data
 
@@ -425,6 +519,8 @@ def dataset_video(path: str, params: ModelParameter, sub_batch_size: int, slice_
         else:
             out_frame = tf.reshape(frame, (sub_batch_size, time_patch_size + 1, frame_height_patch * frame_width_patch,
                                            channel_color_size))
+        if not params.use_bit_fold_input_pipeline:
+            out_frame = tf.cast(out_frame, tf.int32)
 
         concat = tf.reshape(concat, (sub_batch_size, time_patch_size + 1))
         concat = 1 - concat
@@ -462,11 +558,11 @@ def dataset_video(path: str, params: ModelParameter, sub_batch_size: int, slice_
     else:
         interleave_func = lambda x, y: tf.data.Dataset.zip((x, y)).batch(sequence_length + time_patch, drop_remainder=True)
 
-    frame_decoder = get_video_decoder(params,
-                                      language_token_num_per_frame=language_token_per_frame,
-                                      frame_height=frame_height, frame_width=frame_width,
-                                      color_channels=color_channels,
-                                      color_quantization_value=params.color_quantization_value)
+    frame_parser, frame_decoder = get_video_decoder(params,
+                                                    language_token_num_per_frame=language_token_per_frame,
+                                                    frame_height=frame_height, frame_width=frame_width,
+                                                    color_channels=color_channels,
+                                                    color_quantization_value=params.color_quantization_value)
 
     filenames = tf.io.gfile.glob(path)
     data: Dataset = tf.data.Dataset.from_tensor_slices(split_files(filenames, slice_index, slice_count,
@@ -479,8 +575,9 @@ def dataset_video(path: str, params: ModelParameter, sub_batch_size: int, slice_
                            num_parallel_calls=tf2.data.AUTOTUNE)
     data = data.batch(sub_batch_size)
     data = data.map(_pre_func, num_parallel_calls=tf2.data.AUTOTUNE)
+    data = data.prefetch(tf2.data.AUTOTUNE)
 
-    return data
+    return _tune(data, params)
 
 
 def dataset(params: ModelParameter, sub_batch_size, slice_index, slice_count, _):
@@ -490,10 +587,6 @@ def dataset(params: ModelParameter, sub_batch_size, slice_index, slice_count, _)
     :return: tensorflow dataset
     """
 
-    def memory_op(x):
-        x['frame'] = tf.cast(x['frame'], tf.int32)
-        return x
-
     weights = []
     datasets = []
 
@@ -518,11 +611,10 @@ def dataset(params: ModelParameter, sub_batch_size, slice_index, slice_count, _)
     else:
         dset = datasets[0]
 
-    if not params.use_bit_fold_input_pipeline:
-        dset = dset.map(memory_op)
     dset = dset.map(align_tensor_op)
+    dset = dset.prefetch(tf2.data.AUTOTUNE)
 
-    return dset
+    return _tune(dset, params)
 
 
 def gpt_neo_input(params: ModelParameter, sub_batch_size: int, slice_index: int, slice_count: int, runs_log=None):
@@ -537,9 +629,6 @@ def gpt_neo_input(params: ModelParameter, sub_batch_size: int, slice_index: int,
     dset = tf.data.Dataset.zip((tf.data.Dataset.from_tensor_slices(filenames),
                                 tf.data.Dataset.from_tensor_slices(skips)))
 
-    if params.use_random_dataloader:
-        dset = dset.repeat()
-
     def _memory_func(x):
         shp = (sub_batch_size, params.sequence_length // params.token_patch_size + params.output_offset, params.token_patch_size)
         x = tf.cast(tf.reshape(x, shp), tf.int32)
@@ -550,19 +639,35 @@ def gpt_neo_input(params: ModelParameter, sub_batch_size: int, slice_index: int,
             vals1 = vals2 = x
         return {'token_x': vals1, 'token_y': vals2}
 
-    decoder = decode_intstring if 'int64' in filenames[0] else decode_bytestring
-    dset = dset.interleave(lambda x, _skip: _text_decoder(decoder, x, params.sequence_length,
-                                                          params.token_patch_size * params.output_offset, -1,
-                                                          params.shuffle_buffer * int(params.use_random_dataloader),
-                                                          _skip),
-                           cycle_length=params.interleaved_datasets,
-                           num_parallel_calls=params.parallel_interleave)
+    decoder = get_text_decoder(params, filenames[0])
+
+    shuffle_buffer = params.shuffle_buffer * int(params.use_random_dataloader)
+    parse_batch_size = _parse_batch_size(params, params.interleaved_datasets)
+
+    def _decode(files: Dataset) -> Dataset:
+        return files.interleave(lambda x, _skip: _text_decoder(decoder, x, params.sequence_length,
+                                                               params.token_patch_size * params.output_offset, -1,
+                                                               shuffle_buffer, _skip, parse_batch_size),
+                                cycle_length=params.interleaved_datasets,
+                                num_parallel_calls=params.parallel_interleave)
+
+    if params.use_random_dataloader and params.cache_path is not None:
+        # The cache is filled from complete files, as resume offsets only apply to the first pass.
+        cache = _cache_file(params, [file['path'] for file in params.dataset_configs], slice_index, slice_count,
+                            params.sequence_length, params.token_patch_size, params.output_offset)
+        full = Dataset.zip((Dataset.from_tensor_slices(filenames), Dataset.from_tensor_slices([0] * len(filenames))))
+        full = _decode(full).cache(cache).repeat()
+        dset = _decode(dset).concatenate(full) if any(skips) else full
+    else:
+        if params.use_random_dataloader:
+            dset = dset.repeat()
+        dset = _decode(dset)
 
     if params.use_random_dataloader:
         dset = dset.shuffle(params.shuffle_buffer,
                             seed=(params.data_seed if not params.use_random_dataloader else None))
     dset = dset.batch(sub_batch_size)
-    dset = dset.map(_memory_func)
-    dset = dset.map(align_tensor_op)
+    dset = dset.map(lambda x: align_tensor_op(_memory_func(x)), num_parallel_calls=tf2.data.AUTOTUNE)
+    dset = dset.prefetch(tf2.data.AUTOTUNE)
 
-    return dset
+    return _tune(dset, params)
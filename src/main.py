@@ -147,7 +147,8 @@ def main(args: argparse.Namespace) -> None:
                                                                None, params.d_assignment)
 
         if params.train:
-            summary_writer = summary.create_file_writer(params.model_path)
+            summary_writer = summary.create_file_writer(params.model_path, max_queue=params.summary_max_queue,
+                                                        flush_millis=params.summary_flush_millis)
             with summary_writer.as_default(), (summary.always_record_summaries()):
                 computation_func(params,
                                  input_fn,
@@ -254,6 +254,7 @@ def build(params: ModelParameter,
     :param txt_msk: Optional mask to remove loss for certain token positions
     :return: (Generated Video, Total Loss, Video Loss, Token Loss)
     """
+    params.constant_cache.clear()
     with mtf.utils.outside_all_rewrites():
         return scoped(params.model_mode, _build, params, vid, cat_msk_src, cat_msk_tgt, txt_src, txt_tgt, vid_msk_src,
                       vid_msk_tgt, txt_msk)
@@ -1,4 +1,3 @@
-import math
 import typing
 
 import mesh_tensorflow as mtf
@@ -10,7 +9,7 @@ from .embedding import gather_embed
 from .normalization import norm
 from ..dataclass import BlockArgs
 from ..mtf_wrapper import (dropout as utils_dropout, sigmoid, exp, reduce_max, reduce_sum, einsum, reciprocal, reshape,
-                           multiply, stop_gradient)
+                           multiply, stop_gradient, import_fully_replicated)
 from ..utils_mtf import linear_shapes, anonymize_shape, unbind, replace_dim, anonymize_dim
 
 ATTENTION_DIM = typing.NamedTuple("AttentionDim", (('index', int), ('dim', mtf.Dimension)))
@@ -96,7 +95,7 @@ def product_key_memory(args: BlockArgs) -> mtf.Tensor:
     assignment = linear(args, linear_shapes(args).old, [args.params.head_dim] + features)
     assignment = replace_dim(assignment, args.params.key_dim, anonymous_key)  # No-op. Just for MTF propagation
     assignment = norm(args(assignment), features)
-    assignment = mtf.cast(assignment, tf.float64)
+    assignment = mtf.cast(assignment, tf.float32)
     normalizer = reduce_max(assignment, reduced_dim=args.params.key_dim)
     normalizer = reduce_sum(normalizer, reduced_dim=args.params.pkm_dim)
     assignment -= stop_gradient(normalizer)
@@ -105,11 +104,11 @@ def product_key_memory(args: BlockArgs) -> mtf.Tensor:
     normalizer = einsum(unbind(normalizer, args.params.pkm_dim), output_shape=normalizer.shape - args.params.pkm_dim)
 
     val, idx = mtf.top_1(assignment, args.params.key_dim)
-    idx = mtf.einsum([mtf.cast(exp(math.log(args.params.features_per_head) *
-                                   mtf.range(normalizer.mesh, args.params.pkm_dim, dtype=normalizer.dtype)),
-                               tf.int32), idx], output_shape=idx.shape - args.params.pkm_dim)
+    offsets = tf.constant([args.params.features_per_head ** i for i in range(args.params.pkm_axes)], tf.int32)
+    offsets = import_fully_replicated(args.params, offsets, [args.params.pkm_dim], "pkm_offsets")
+    idx = mtf.einsum([offsets, idx], output_shape=idx.shape - args.params.pkm_dim)
     val = einsum(unbind(val, args.params.pkm_dim), output_shape=val.shape - args.params.pkm_dim) / normalizer
-    val = mtf.cast(val, args.params.variable_dtype.activation_dtypex)
+    val = mtf.cast(val, args.params.variable_dtype.activation_dtype)
     out = gather_embed(args(idx), [args.params.product_key_value_dim] + args.params.feature_dims,
                        [args.params.head_dim])
     return out * val
@@ -1,3 +1,4 @@
+import functools
 import typing
 
 import mesh_tensorflow as mtf
@@ -7,16 +8,23 @@ from scipy.special import erfinv
 
 from .backend import normal_var, SHAPE
 from ..dataclass import BlockArgs
-from ..mtf_wrapper import einsum, reduce_mean, rsqrt_eps, square
+from ..mtf_wrapper import cast, einsum, maximum, reduce_mean, rsqrt_eps, square
 from ..utils_mtf import linear_shapes
 
 tf1 = tf.compat.v1
 
 
-def uniformly_sampled_gaussian(num_rand, dtype):
+@functools.lru_cache(maxsize=None)
+def _uniformly_sampled_gaussian(num_rand: int) -> np.ndarray:
     rand = 2 * (np.arange(num_rand) + 0.5) / float(num_rand) - 1
     rand = np.sqrt(2) * erfinv(rand)
-    return tf.constant(rand, dtype=dtype)
+    rand.flags.writeable = False
+    return rand
+
+
+def uniformly_sampled_gaussian(num_rand, dtype):
+    # Only the numpy table is cached, as tf.constant belongs to the graph it's created in.
+    return tf.constant(_uniformly_sampled_gaussian(num_rand), dtype=dtype)
 
 
 def norm(args: BlockArgs, feature_shape: typing.Optional[SHAPE] = None) -> mtf.Tensor:
@@ -24,8 +32,12 @@ def norm(args: BlockArgs, feature_shape: typing.Optional[SHAPE] = None) -> mtf.T
     feature_shape = mtf.Shape(linear_shapes(args).old if feature_shape is None else feature_shape)
     normalized_shape = block_input.shape - (feature_shape - [args.params.head_dim] * ('group' in args))
 
-    block_input -= reduce_mean(block_input, output_shape=normalized_shape)
-    scale = [rsqrt_eps(reduce_mean(square(block_input), output_shape=normalized_shape), 1e-5), block_input]
+    # Both moments are reduced in float32 straight from the input, as E[x^2] - E[x]^2 cancels catastrophically in
+    # bfloat16 once |mean| >> std.
+    fp32_input = cast(block_input, tf.float32)
+    mean = reduce_mean(fp32_input, output_shape=normalized_shape)
+    variance = maximum(reduce_mean(square(fp32_input), output_shape=normalized_shape) - square(mean), 0)
+    scale = [cast(rsqrt_eps(variance, 1e-5), block_input.dtype), block_input - cast(mean, block_input.dtype)]
     if 'scale' in args:
         scale.append(normal_var(args, feature_shape, mean=1))
     block_input = einsum(scale, output_shape=block_input.shape)
@@ -6,8 +6,9 @@ import tensorflow as tf
 from .basic import activated_linear_in, activated_linear_out
 from .activation import activate
 from .embedding import embed
+from .. import tf_wrapper as tfw
 from ..dataclass import BlockArgs
-from ..mtf_wrapper import einsum, greater_equal, multiply, less, exp, reduce_max, reduce_sum
+from ..mtf_wrapper import einsum, greater_equal, multiply
 from ..utils_mtf import (anonymize, anonymize_dim, compare_range, get_attention_dim, is_masked, linear_shapes,
                          random_name)
 
@@ -16,6 +17,74 @@ ATTENTION_DIM = typing.NamedTuple("AttentionDim", (('index', int), ('dim', mtf.D
 tf1 = tf.compat.v1
 
 
+def _causal_mask(shape: typing.List[int], query_axis: int, key_axis: int) -> tf.Tensor:
+    def _position(axis: int) -> tf.Tensor:
+        return tf.reshape(tf.range(shape[axis]), [size if idx == axis else 1 for idx, size in enumerate(shape)])
+
+    return tf.greater_equal(_position(query_axis), _position(key_axis))
+
+
+class SoftmaxForward(mtf.Operation):
+    def __init__(self, x: mtf.Tensor, dim: mtf.Dimension, masked_dim: typing.Optional[mtf.Dimension] = None,
+                 bfloat16_exp: bool = False):
+        super().__init__([x], name=random_name("softmax_forward"))
+        self.dim = dim
+        self.masked_dim = masked_dim
+        self.bfloat16_exp = bfloat16_exp
+        self._outputs = [mtf.Tensor(self, x.shape, x.dtype)]
+
+    def gradient(self, grad_ys):
+        return SoftmaxBackward(self.outputs[0], grad_ys[0], self.dim).outputs
+
+    def lower(self, lowering):
+        mesh_impl = lowering.mesh_impl(self)
+        dims = self.inputs[0].shape.dims
+        axis = dims.index(self.dim)
+
+        def slicewise_fn(x):
+            if self.masked_dim is not None:
+                mask = _causal_mask(x.shape.as_list(), dims.index(self.masked_dim), axis)
+                x = tf.where(mask, x, tf.constant(-float('inf'), dtype=x.dtype))
+            if not self.bfloat16_exp or x.dtype != tf.float32:
+                return tfw.softmax(x, axis)
+            x = tfw.exp(tfw.cast(tfw.subtract(x, tfw.reduce_max(x, axis)), tf.bfloat16))
+            x = tfw.cast(x, tf.float32)
+            return tfw.divide(x, tfw.reduce_sum(x, axis))
+
+        y = mesh_impl.slicewise(slicewise_fn, lowering.tensors[self.inputs[0]])
+        lowering.set_tensor_lowering(self.outputs[0], y)
+
+
+class SoftmaxBackward(mtf.Operation):
+    def __init__(self, y: mtf.Tensor, dy: mtf.Tensor, dim: mtf.Dimension):
+        super().__init__([y, dy], name=random_name("softmax_backward"))
+        self.dim = dim
+        self._outputs = [mtf.Tensor(self, y.shape, y.dtype)]
+
+    def lower(self, lowering):
+        mesh_impl = lowering.mesh_impl(self)
+        axis = self.inputs[0].shape.dims.index(self.dim)
+
+        def slicewise_fn(y, dy):
+            y_dy = tfw.multiply(y, dy)
+            return tfw.subtract(y_dy, tfw.multiply(y, tfw.reduce_sum(y_dy, axis)))
+
+        y = mesh_impl.slicewise(slicewise_fn, lowering.tensors[self.inputs[0]], lowering.tensors[self.inputs[1]])
+        lowering.set_tensor_lowering(self.outputs[0], y)
+
+
+def softmax(x: mtf.Tensor, dim: mtf.Dimension, masked_dim: typing.Optional[mtf.Dimension] = None,
+            bfloat16_exp: bool = False) -> mtf.Tensor:
+    """
+    Softmax over a dimension that is not split across the mesh. The backward pass computes the jacobian-vector
+    product as y * (dy - sum(y * dy)) in a single op.
+    If masked_dim is given, positions of dim that lie after the position of masked_dim are excluded (causal mask).
+    The boolean mask is built inside the op instead of adding a dense float bias.
+    With bfloat16_exp, float32 inputs are exponentiated in bfloat16 while max and sum stay in float32.
+    """
+    return SoftmaxForward(x, dim, masked_dim, bfloat16_exp).outputs[0]
+
+
 def _masked_map(args: BlockArgs) -> typing.Tuple[mtf.Tensor, typing.Union[mtf.Tensor, int]]:
     dim = get_attention_dim(args).dim
     tmp = anonymize_dim(dim)
@@ -65,10 +134,7 @@ def attention(args: BlockArgs) -> mtf.Tensor:
     if 'biased_softmax' in args:
         logit += multiply(*_masked_map(args))
     if logit != 0:
-        logit += (compare_range(args.params, dim, tmp, less) * 1e38) * -2
-        logit -= mtf.stop_gradient(reduce_max(logit, reduced_dim=tmp))
-        logit = exp(logit)
-        logit /= reduce_sum(logit, reduced_dim=tmp)
+        logit = softmax(logit, tmp, dim, args.params.bfloat16_softmax)
     if 'biased_attention_map' in args:
         logit += multiply(*_masked_map(args))
     if 'scale_attention_map' in args:
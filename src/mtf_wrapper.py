@@ -145,8 +145,16 @@ def constant(params: ModelParameter, value: typing.Union[int, float], shape: OPT
                   params.variable_dtype.activation_dtype if dtype is None else dtype)
 
 
+def _cached_constant(params: ModelParameter, name: str, value: typing.Union[int, float], shape: OPT_SHAPE,
+                     dtype: tf.DType) -> mtf.Tensor:
+    key = (name, value, None if shape is None else tuple(mtf.Shape(shape).dims), dtype)
+    if key not in params.constant_cache:
+        params.constant_cache[key] = scoped(name, mtf.constant, params.mesh, value, shape, dtype)
+    return params.constant_cache[key]
+
+
 def constant_float(params: ModelParameter, value: typing.Union[int, float], shape: OPT_SHAPE = None) -> mtf.Tensor:
-    return scoped("constant_float", mtf.constant, params.mesh, value, shape, tf.float32)
+    return _cached_constant(params, "constant_float", value, shape, tf.float32)
 
 
 def constant_int(params: ModelParameter, value: typing.Union[int, float], shape: OPT_SHAPE = None) -> mtf.Tensor:
@@ -159,7 +167,7 @@ def constant_scalar(params: ModelParameter, value: typing.Union[int, float], dty
 
 
 def optimizer_scalar(params: ModelParameter, value: typing.Union[int, float]) -> mtf.Tensor:
-    return scoped("optimizer_scalar", mtf.constant, params.mesh, value, [], params.optimizer_calculation_dtype)
+    return _cached_constant(params, "optimizer_scalar", value, [], params.optimizer_calculation_dtype)
 
 
 def greater_equal(x1: mtf.Tensor, x2: mtf.Tensor, output_shape: OPT_SHAPE = None) -> mtf.Tensor:
@@ -274,6 +282,10 @@ def minimum(x1: mtf.Tensor, x2: typing.Union[mtf.Tensor, int, float], output_sha
     return scoped("minimum", mtf.minimum, x1, x2, output_shape)
 
 
+def where(condition: mtf.Tensor, x1: mtf.Tensor, x2: mtf.Tensor, output_shape: OPT_SHAPE = None) -> mtf.Tensor:
+    return scoped("where", mtf.where, condition, x1, x2, output_shape)
+
+
 def add_n(*xs: typing.Union[typing.List[TENSORS], TENSORS]) -> mtf.Tensor:
     if len(xs) == 1 and not isinstance(xs[0], mtf.Tensor):
         xs = xs[0]
@@ -16,9 +16,9 @@ from .learning_rate import get_learning_rate
 from .optimizers import OPTIMIZERS
 from ..dataclass import ModelParameter
 from ..mtf_wrapper import (cast, constant_float, constant_scalar, einsum, equal, greater_equal, mod, reduce_sum, assign,
-                           add, multiply, scoped, identity, zeros_like, negative, optimizer_scalar, reciprocal,
-                           reduce_mean, broadcast, assign_sub, assign_add, subtract, get_variable_for_tensor)
-from ..utils_mtf import feature_dims_used, to_fp32, gradient_iterator
+                           add, scoped, identity, zeros_like, optimizer_scalar, reduce_mean, broadcast, assign_sub,
+                           assign_add, subtract, get_variable_for_tensor, where, multiply, maximum)
+from ..utils_mtf import gradient_iterator
 
 tf = tf2.compat.v1
 zeros = tf.zeros_initializer()
@@ -37,7 +37,10 @@ def update(ctx: OptimizerCtx):
     if ctx.grad_buffer is not None:
         ctx.grad = reduce_mean(broadcast(identity(ctx.grad_buffer.value), [params.batch_dim] + ctx.grad.shape.dims),
                                params.batch_dim)
-        ctx.update_ops.append((assign if ctx.assign else mtf.multiply)(ctx.grad_buffer, zeros_like(ctx.grad)))
+        if ctx.assign:
+            ctx.update_ops.append(assign(ctx.grad_buffer, zeros_like(ctx.grad)))
+        else:
+            ctx.update_ops.append(multiply(ctx.grad_buffer, 0))
 
     for opt in params.optimizer.split('-'):
         opt, *args = opt.split(':')
@@ -46,21 +49,21 @@ def update(ctx: OptimizerCtx):
     if 'rezero' in var.name:
         ctx.grad *= params.rezero_lr_multiplier
 
-    features_used = feature_dims_used(params, var)
-    large_tensor = features_used and len(var.shape.dims) > len(params.feature_dims)
-    large_tensor |= not features_used and len(var.shape.dims) >= 2  # not norm or rezero + scalable catch-all
-    large_tensor &= var.shape.size > 1  # not rezero
-    large_tensor &= "norm" not in var.name  # not norm
-    large_tensor &= "rezero" not in var.name  # not norm
-    large_tensor &= "embed" not in var.name  # not input/output embedding, position embedding, attention map bias
-    large_tensor &= "input" not in var.name or "lang_in" in var.name or "vid_in" in var.name  # not input
-    large_tensor &= "output" not in var.name or "lang_out" in var.name or "vid_out" in var.name  # not output
-
-    if large_tensor and params.weight_decay > 0:
+    weight_decay = var.large_tensor and params.weight_decay > 0
+    if weight_decay and ctx.assign and var.slice_dtype != var.activation_dtype:
+        # var.value is rounded to the activation dtype, so the decay is folded into the gradient to keep the
+        # full-precision slices for assign_sub
         ctx.grad += einsum([cast(var.value, params.optimizer_calculation_dtype), learning_rate,
                             optimizer_scalar(params, params.weight_decay)], output_shape=var.shape)
-
-    if ctx.assign:
+        weight_decay = False
+
+    if weight_decay:
+        # var - grad - var * lr * wd == var * (1 - lr * wd) - grad, so the variable is read and written once
+        decay = 1 - learning_rate * optimizer_scalar(params, params.weight_decay)
+        value = einsum([cast(var.value, params.optimizer_calculation_dtype), decay], output_shape=var.shape)
+        value -= ctx.grad
+        update_ops.append(assign(ctx.var, value) if ctx.assign else cast(value, params.calculation_dtype))
+    elif ctx.assign:
         update_ops.append(assign_sub(ctx.var, ctx.grad))
     else:
         update_ops.append(subtract(ctx.var, mtf.cast(ctx.grad, params.calculation_dtype)))
@@ -105,7 +108,17 @@ def get_optimizer(loss_list: typing.List[mtf.Tensor], params: ModelParameter, ma
         loss_2__loss_2 = constant_float(params, 0, shape=[params.head_dim])
 
     tensor_to_gradient: typing.Dict[mtf.Tensor, typing.List[int, int, mtf.Tensor, mtf.Operation]] = {}
+    xs = []
     tensor_to_var = {}
+    for x in params.variable_cache.values():
+        x: typing.Union[mtf.AddOperation, mtf.Variable] = x
+        value: mtf.Tensor = x.outputs[0]
+        op = get_variable_for_tensor(value)
+        if not op.trainable:
+            continue
+        xs.append(value)
+        tensor_to_var[value] = x
+    xs = frozenset(xs)
 
     for loss_idx, loss in enumerate(loss_list):
         if mgda and loss_idx == 2:
@@ -113,42 +126,31 @@ def get_optimizer(loss_list: typing.List[mtf.Tensor], params: ModelParameter, ma
             v1v2 = reduce_sum(loss_1__loss_2, output_shape=[])
             v2v2 = reduce_sum(loss_2__loss_2, output_shape=[])
             min_gamma = 0.001
-            gamma = multiply(constant_float(params, value=(1 - min_gamma), shape=[]),
-                             to_fp32(greater_equal(v1v2, v1v1)))
-            gamma += einsum([constant_float(params, value=min_gamma, shape=[]), to_fp32(greater_equal(v1v2, v2v2)),
-                             to_fp32(equal(gamma, 0))], output_shape=[])
-            gamma += einsum([optimizer_scalar(params, -1),
-                             to_fp32(equal(gamma, 0)),
-                             add(v1v2, negative(v2v2)),
-                             reciprocal(add(v1v1, v2v2) - multiply(-2, v1v2))],
-                            output_shape=[])
+            gamma = scoped("mgda_gamma", where, greater_equal(v1v2, v1v1),
+                           constant_float(params, value=(1 - min_gamma), shape=[]),
+                           where(greater_equal(v1v2, v2v2),
+                                 constant_float(params, value=min_gamma, shape=[]),
+                                 (v2v2 - v1v2) / maximum(v1v1 + v2v2 - v1v2 * 2, 1e-12)))
 
             loss = loss_list[0] * gamma + loss_list[1] * (1 - gamma)
 
         operations = loss.graph.operations
-        xs = []
-        tensor_to_var = {}
-        for x in params.variable_cache.values():
-            x: typing.Union[mtf.AddOperation, mtf.Variable] = x
-            value: mtf.Tensor = x.outputs[0]
-            op = get_variable_for_tensor(value)
-            if not op.trainable:
-                continue
-            xs.append(value)
-            tensor_to_var[value] = x
-
         loss_grad = constant_scalar(params, 1.0)
         downstream = set(xs)
 
+        # Operations are topologically sorted, so an op is known to be downstream once its inputs were visited. Only
+        # those ops can produce gradients for the variables, so the backward pass walks this list instead of the graph.
+        downstream_ops = []
         for op in operations:
-            if op.has_gradient and (set(op.inputs) & downstream):
-                downstream |= set(op.outputs)
+            if op.has_gradient and any(inp in downstream for inp in op.inputs):
+                downstream.update(op.outputs)
+                downstream_ops.append(op)
 
         tensor_to_gradient: typing.Dict[mtf.Tensor, typing.List[int, int, mtf.Tensor,
                                                                 mtf.Operation]] = {loss: [0, 0, loss_grad, None]}
 
         with tf.variable_scope(loss.graph.captured_variable_scope):
-            for op in operations[::-1]:
+            for op in reversed(downstream_ops):
                 grad_outputs = []
                 for out in op.outputs:
                     if out not in tensor_to_gradient:
@@ -159,7 +161,7 @@ def get_optimizer(loss_list: typing.List[mtf.Tensor], params: ModelParameter, ma
                     grad_outputs.append(grad_list[2])
                     grad_list[0] += 1
 
-                if not op.has_gradient or not any(grad_outputs) or not (set(op.inputs) & downstream):
+                if not any(grad_outputs):
                     continue
                 for inner_op, inp, grad in gradient_iterator(params, op, grad_outputs):
                     if inp not in downstream or grad is None:
@@ -1,5 +1,5 @@
-import collections
 import json
+import re
 
 import jsonpickle
 import numpy as np
@@ -12,6 +12,7 @@ from ..dataclass import ModelParameter
 
 tf1 = tf.compat.v1
 Dataset = tf1.data.Dataset
+HOST_ID = re.compile(r"/task:(\d+)/device:", re.IGNORECASE)
 
 
 def place_dataloader(params: ModelParameter, input_fn):
@@ -20,7 +21,6 @@ def place_dataloader(params: ModelParameter, input_fn):
     ordered_ordinals = []
     ordered_hosts = []
     ordered_host_ids = []
-    host_id_to_its_pnums = collections.defaultdict(list)
     d_assignment = params.mesh_impl.device_assignment
 
     for pnum in range(num_cores):
@@ -29,14 +29,14 @@ def place_dataloader(params: ModelParameter, input_fn):
         # For MTF, there's always 1 core per replica. So logical_core=0.
         ordered_ordinals.append(d_assignment.tpu_ordinal(replica=physical_pnum, logical_core=0))
         host_device = d_assignment.host_device(replica=physical_pnum)
-        host_id = int(host_device.lower().split("/task:")[1].split("/device:")[0])
         ordered_hosts.append(host_device)
-        ordered_host_ids.append(host_id)
-        host_id_to_its_pnums[host_id].append(pnum)
+        ordered_host_ids.append(int(HOST_ID.search(host_device).group(1)))
 
     num_hosts = len(set(ordered_hosts))
 
     pnum_maps = []
+    slice_begins = []
+    slice_shapes = []
     macro_batching_multi = params.macro_batching if params.train else 1
     batch_size = params.input_pipeline_shape[0].to_integer_list[0] * macro_batching_multi
     for mtf_shape in params.input_pipeline_shape:
@@ -44,45 +44,39 @@ def place_dataloader(params: ModelParameter, input_fn):
         assert batch_size == mtf_shape.to_integer_list[0] * macro_batching_multi
 
         s_shape = params.mesh_impl.slice_shape(mtf_shape)
+        slice_shapes.append(s_shape)
         shape_list = [dim_size // s_dim_size for dim_size, s_dim_size in zip(mtf_shape.to_integer_list, s_shape)]
 
         pnum_map_shape = shape_list + [num_cores // np.prod(shape_list)]
         assert np.prod(pnum_map_shape) == num_cores
 
-        # Initialize the pnum_map to None.
-        pnum_map = np.empty(pnum_map_shape, dtype=object)
-        pnum_map[:] = None
-
-        for pnum in range(num_cores):
-            s_begin = params.mesh_impl.slice_begin(mtf_shape, pnum)
-            coord = [dim_size // s_dim_size for dim_size, s_dim_size in zip(s_begin, s_shape)]
-            # put pnum in pnum_map[coord]
-            pnum_array_ref = pnum_map[tuple(coord)]
-            for idx, value in enumerate(pnum_array_ref):
-                if value is None:
-                    pnum_array_ref[idx] = pnum
-                    break
-
-        pnum_maps.append(pnum_map)
+        # Every pnum is put at the coordinate of its slice. The stable sort keeps the pnums sharing a coordinate in
+        # ascending order, so pnum_map[coord] is filled the same way a linear probe over all pnums would fill it.
+        s_begins = np.array([params.mesh_impl.slice_begin(mtf_shape, pnum) for pnum in range(num_cores)])
+        slice_begins.append(s_begins)
+        coords = s_begins // s_shape
+        flat_coords = np.ravel_multi_index(tuple(coords.T), shape_list)
+        assert np.all(np.bincount(flat_coords, minlength=np.prod(shape_list)) == pnum_map_shape[-1])
+        pnum_maps.append(np.argsort(flat_coords, kind='stable').reshape(pnum_map_shape))
 
     # For each sub-batch, we need to know which host should read it.
     if params.train:
 
+        # Number of pnums every host holds of each sub-batch, counted for all sub-batches at once.
+        sub_batch_hosts = np.array(ordered_host_ids)[pnum_maps[0].reshape(pnum_maps[0].shape[0], -1)]
+        num_pnums_per_host = (sub_batch_hosts[:, :, None] == np.arange(num_hosts)).sum(1)
+
         # This records how many datasets (ds) are already stored on each host.
-        num_dss_per_host = [0] * num_hosts
+        num_dss_per_host = np.zeros(num_hosts, dtype=np.int64)
 
         # A list of host_ids that holds datasets (ds).
         hosts_to_hold_ds = []
 
-        for sub_batch_pnum_map in pnum_maps[0]:
-
-            num_pnums_per_host = [0] * num_hosts
-            for pnum in sub_batch_pnum_map.flatten():
-                num_pnums_per_host[ordered_host_ids[pnum]] += 1
-
-            host_metrics = [(host_id, num_pnums_per_host[host_id], num_dss_per_host[host_id]) for host_id in
-                            range(num_hosts)]
-            host_id, _, _ = max(host_metrics, key=lambda keys: (keys[1], -keys[2]))
+        for pnums_per_host in num_pnums_per_host:
+            # The host with the most pnums of this sub-batch wins, ties go to the one holding the fewest datasets and
+            # then to the lowest host_id.
+            candidates = np.flatnonzero(pnums_per_host == pnums_per_host.max())
+            host_id = int(candidates[np.argmin(num_dss_per_host[candidates])])
 
             num_dss_per_host[host_id] += 1
             hosts_to_hold_ds.append(host_id)
@@ -135,6 +129,24 @@ def place_dataloader(params: ModelParameter, input_fn):
                 if run_log[-1]['steps'] <= 0:
                     run_log = None
 
+    # Every host pipeline is tuned the same way, so the options are only built once.
+    options = tf.data.Options()
+    # options.autotune.enabled = True
+    # options.deterministic = not params.train
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.AUTO
+    options.experimental_optimization.filter_fusion = True
+    options.experimental_optimization.apply_default_optimizations = True
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.map_and_filter_fusion = True
+    options.experimental_optimization.map_fusion = True
+    options.experimental_optimization.map_parallelization = True
+    options.experimental_optimization.noop_elimination = True
+    options.experimental_optimization.parallel_batch = True
+    options.experimental_optimization.shuffle_and_repeat_fusion = True
+    options.experimental_slack = True
+    options.threading.private_threadpool_size = 96
+    options.threading.max_intra_op_parallelism = 1
+
     ds_iterator = []
     # For each sub-batch, create a SubBatchSlicer object.
     for sub_batch_i, host_id in enumerate(hosts_to_hold_ds):
@@ -155,22 +167,6 @@ def place_dataloader(params: ModelParameter, input_fn):
             if not params.use_random_dataloader and params.train and params.use_video:
                 dataset = dataset.skip(params.current_step // params.macro_batching)
             dataset = dataset.prefetch(params.buffer_size)
-            options = tf.data.Options()
-            # options.autotune.enabled = True
-            # options.deterministic = not params.train
-            options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.AUTO
-            options.experimental_optimization.filter_fusion = True
-            options.experimental_optimization.apply_default_optimizations = True
-            options.experimental_optimization.map_and_batch_fusion = True
-            options.experimental_optimization.map_and_filter_fusion = True
-            options.experimental_optimization.map_fusion = True
-            options.experimental_optimization.map_parallelization = True
-            options.experimental_optimization.noop_elimination = True
-            options.experimental_optimization.parallel_batch = True
-            options.experimental_optimization.shuffle_and_repeat_fusion = True
-            options.experimental_slack = True
-            options.threading.private_threadpool_size = 96
-            options.threading.max_intra_op_parallelism = 1
             dataset: Dataset = dataset.with_options(options)
             _ds_iterator = tf1.data.make_initializable_iterator(dataset)
             ds_iterator.append(_ds_iterator)
@@ -183,26 +179,28 @@ def place_dataloader(params: ModelParameter, input_fn):
             for input_i in range(len(all_input_tensors)):
                 input_tensor = all_input_tensors[input_i]
                 sub_batch_pnums = all_sub_batch_pnums[input_i]
-                mtf_input_shape = params.input_pipeline_shape[input_i]
+                s_shape = list(slice_shapes[input_i])
+                s_shape[0] = s_shape[0] * macro_batching_multi
 
-                # Initialize the cache for each input_i
-                _slice_dict = collections.defaultdict(list)
+                # Replicated pnums share a slice begin, so each distinct slice of this input is only created once.
+                # A slice spanning the whole sub-batch (the usual case when only the batch is split) is the input
+                # itself, so no Slice op is emitted for it.
+                _slice_dict = {}
+                if input_tensor.shape.as_list() == s_shape:
+                    _slice_dict[(0,) * len(s_shape)] = input_tensor
 
-                for idx, pnum in enumerate(sub_batch_pnums):
+                for pnum in sub_batch_pnums:
 
-                    s_begin = params.mesh_impl.slice_begin(mtf_input_shape, pnum)
+                    s_begin = slice_begins[input_i][pnum].tolist()
                     if not not params.train:
                         # Always slice from 0 in the first dimension (batch dimension), since
                         # input_tensor a sub-batch tensor.
                         s_begin[0] = 0
-                    if tuple(s_begin) in _slice_dict:
-                        input_slice = _slice_dict[tuple(s_begin)]
-                    else:
-                        s_shape = params.mesh_impl.slice_shape(mtf_input_shape)
-                        s_shape[0] = s_shape[0] * macro_batching_multi
-                        input_slice = tfw.slice(input_tensor, s_begin, s_shape)
-
-                    all_laidout_tensors[pnum][input_i] = input_slice
+                    key = tuple(s_begin)
+                    if key not in _slice_dict:
+                        _slice_dict[key] = tfw.slice(input_tensor, s_begin, s_shape)
+
+                    all_laidout_tensors[pnum][input_i] = _slice_dict[key]
 
     # Make sure that there are no Nones in all_laidout_tensors.
     for laidout_tensors in all_laidout_tensors:
@@ -20,7 +20,7 @@ def autoregressive_model(params: ModelParameter,
         # todo: fix token shift for video (Jan).
         tkn_per_frame = mtf.Dimension("language_token_per_frame",
                                       params.language_token_per_frame)
-        shape = [params.batch_dim, params.sequence_dim, tkn_per_frame, params.vocab_dim]
+        shape = [params.batch_dim, params.sequence_dim, tkn_per_frame]
 
         def body_fn(position, token_x_input, token_y_input, frame_input,
                     frame_mask_src, frame_mask_tag, token_mask, *states):
@@ -40,15 +40,17 @@ def autoregressive_model(params: ModelParameter,
 
             if params.use_language:
                 one_hot_sequence = one_hot(position, params.sequence_dim, dtype=tf.float32)
-                token_out = argmax(reshape(token_out, new_shape=shape), params.vocab_dim)
+                # The vocab dimension is reduced before reshaping, so only the token ids are folded into one
+                # language_token_per_frame dimension and the ids in token_dim_shape are written back as they are.
+                token_ids = argmax(token_out, params.vocab_dim)
+                token_out = reshape(token_ids, new_shape=shape)
                 padding_token = to_fp32(equal(token_out, params.padding_token))
 
-                token_x_input = weighted_add(reshape(token_out, new_shape=params.token_dim_shape),
-                                             token_x_input,
+                token_x_input = weighted_add(token_ids, token_x_input,
                                              one_hot(position, params.sequence_dim, dtype=tf.int32))
 
-                token_pad = less_equal(mtf_range(params.mesh, tkn_per_frame, dtype=tf.float32),
-                                       to_fp32(argmax(padding_token, reduced_dim=tkn_per_frame)),
+                token_pad = less_equal(mtf_range(params.mesh, tkn_per_frame, dtype=tf.int32),
+                                       argmax(padding_token, reduced_dim=tkn_per_frame),
                                        output_shape=token_out.shape)
 
                 token_mask = weighted_add(reshape(to_fp32(token_pad), new_shape=params.token_dim_shape),
@@ -1,5 +1,6 @@
 import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
 import mesh_tensorflow as mtf
 import numpy as np
@@ -135,6 +136,9 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
 
             with tf.control_dependencies(comput_ops):
                 global_step = tf1.train.get_or_create_global_step()
+                # Cast the global step to tf.int32 once for all summaries, since
+                # outside_compilation does not support tf.int64.
+                summary_step = tfw.cast(global_step, tf.int32)
 
                 step = tfw.mod(tfw.add(manual_global_step, 1),
                                tfw.constant(params.grad_accumulation, dtype=tf.int64))
@@ -142,7 +146,7 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
                 step = tfw.cast(step, tf.int64)
 
                 tf_loss = tfw.cast(lowering.export_to_tf_tensor(loss), tf.float32)
-                comput_ops.append(add_summary(tf_loss=tf_loss, value=log_dict, global_step=global_step))
+                comput_ops.append(add_summary(tf_loss=tf_loss, value=log_dict, global_step=summary_step))
 
                 if params.debug_gradients:
                     for grad_key in debug_gradients_dict.keys():
@@ -150,7 +154,7 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
                             tfw.cast(lowering.export_to_tf_tensor(debug_gradients_dict[grad_key]), tf.float32)
 
                     comput_ops.append(add_histogram(tf_loss=tf_loss, value=debug_gradients_dict,
-                                                    global_step=global_step))
+                                                    global_step=summary_step))
 
                 comput_ops.append(tfw.assign_add(global_step, step * tfw.constant(params.macro_batching, tf.int64)))
                 comput_ops.append(tfw.assign_add(manual_global_step, tfw.constant(params.macro_batching, tf.int64)))
@@ -248,30 +252,32 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
             current_step = current_step * params.grad_accumulation
             for i in range(current_step, params.train_steps * params.grad_accumulation, params.macro_batching):
 
-                sess.run(computation)
+                # The batch of this step is already in the infeed queue, so the next one is read and enqueued by the
+                # hosts while the TPU computes instead of after it finished.
+                sess.run([computation, enqueue_ops])
                 if params.debug_train_step or i < first_print_threshold:
                     color_print(params, f"Current global step: {i // params.grad_accumulation}"
                                         f"   accumulation step: {i % params.grad_accumulation}")
 
-                sess.run(enqueue_ops)
-                if params.debug_train_step:
-                    color_print(params, f"Enqueueing...")
-
-                sess.run(flush_summary)
-                if params.debug_train_step:
-                    color_print(params, f"Flushing summary...")
+            # The writer flushes on its own every summary_flush_millis, so the queue only has to be emptied once at the
+            # end instead of blocking the host after every step.
+            sess.run(flush_summary)
+            if params.debug_train_step:
+                color_print(params, f"Flushing summary...")
 
     else:  # train == 'sample'
         outfeed_dequeue_ops = []
+        drain_ops = []
         for host_id in range(params.num_hosts):
             with ops.device(host_id_to_tf_device.format(host_id)):
                 for device_ordinal in range(params.num_cores_per_host):
                     outfeed_dequeue_op = tpu_ops.outfeed_dequeue_tuple(dtypes=[tf.float32] * len(output_shapes),
                                                                        shapes=output_shapes,
                                                                        device_ordinal=device_ordinal)
-                    # We don't need output other than from core 0.
-                    outfeed_dequeue_ops.append([tf.reduce_mean(x) for x in outfeed_dequeue_op]
-                                               if outfeed_dequeue_ops else outfeed_dequeue_op)
+                    # We don't need output other than from core 0. The other cores still have to be drained, or their
+                    # outfeed blocks the next step, but nothing of them is reduced or fetched.
+                    (drain_ops if outfeed_dequeue_ops else outfeed_dequeue_ops).append(outfeed_dequeue_op)
+        outfeed_dequeue_ops.append(tfw.group(drain_ops))
         with tf1.train.MonitoredSession(session_creator=tf1.train.ChiefSessionCreator(master=cluster_resolver.master(),
                                                                                       config=session_config),
                                         hooks=[ckpt_loader_hook, hooks[0]]) as sess:
@@ -287,22 +293,31 @@ def computation_func(params: ModelParameter, input_fn: typing.Callable,
                 color_print(params, "Initializing inputs...")
                 sess.run(input_initializers)
 
-            while True:
-
-                if query_input_fns is None:
-                    feed_dict = None
-                else:
-                    _prompt, _iter_pos, _samp_temp, _end_iter = query_input_fns()
-                    feed_dict = {prompt: _prompt,
-                                 iter_pos: _iter_pos,
-                                 samp_temp: _samp_temp,
-                                 end_iter: _end_iter
-                                 }
-
-                sess.run(enqueue_ops, feed_dict=feed_dict)
-
-                sess.run(computation)
-                out = sess.run(outfeed_dequeue_ops)[0]
-
-                for fn in callback_fns:
-                    fn(out)
+            # Callbacks run on a single worker, so they keep their order while the next sample is computed. At most one
+            # is in flight, which also surfaces its exceptions one step later.
+            with ThreadPoolExecutor(max_workers=1) as callback_pool:
+                callback = None
+                while True:
+
+                    if query_input_fns is None:
+                        feed_dict = None
+                    else:
+                        # The interactive input and output functions share state, so the previous response has to be
+                        # handled before the next query is read.
+                        if callback is not None:
+                            callback.result()
+                        _prompt, _iter_pos, _samp_temp, _end_iter = query_input_fns()
+                        feed_dict = {prompt: _prompt,
+                                     iter_pos: _iter_pos,
+                                     samp_temp: _samp_temp,
+                                     end_iter: _end_iter
+                                     }
+
+                    sess.run(enqueue_ops, feed_dict=feed_dict)
+
+                    sess.run(computation)
+                    out = sess.run(outfeed_dequeue_ops)[0]
+
+                    if callback is not None:
+                        callback.result()
+                    callback = callback_pool.submit(lambda x: [fn(x) for fn in callback_fns], out)
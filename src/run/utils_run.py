@@ -38,9 +38,8 @@ def add_summary(tf_loss, value, global_step):
         with tfw.control_dependencies([summary.scalar(key, local_value[key], step=gs) for key in local_value.keys()]):
             return tfw.identity(local_tf_loss)
 
-    # Cast the global step to tf.int32, since
-    # outside_compilation does not support tf.int64.
-    return tpu.outside_compilation(_host_loss_summary, tf_loss, value, tfw.cast(global_step, tf.int32))
+    # global_step is tf.int32, since outside_compilation does not support tf.int64.
+    return tpu.outside_compilation(_host_loss_summary, tf_loss, value, global_step)
 
 
 def add_histogram(tf_loss, value, global_step):
@@ -53,9 +52,8 @@ def add_histogram(tf_loss, value, global_step):
                                        for key in local_value.keys()]):
             return tfw.identity(local_tf_loss)
 
-    # Cast the global step to tf.int32, since
-    # outside_compilation does not support tf.int64.
-    return tpu.outside_compilation(_host_loss_summary, tf_loss, value, tfw.cast(global_step, tf.int32))
+    # global_step is tf.int32, since outside_compilation does not support tf.int64.
+    return tpu.outside_compilation(_host_loss_summary, tf_loss, value, global_step)
 
 
 def _import_tensor(params: ModelParameter, tensor, shape, name):
@@ -64,14 +62,18 @@ def _import_tensor(params: ModelParameter, tensor, shape, name):
 
 def analyze_model(params: ModelParameter, time_to_build: float, graph: mtf.Graph):
     color_print(params, f"Built in {time_to_build:.1f}s")
-    param_count = int(sum([variable.size for variable in graph.trainable_variables]))
-    var_count = int(sum([variable.size for variable in graph.all_variables]))
-    embed_param_count = int(sum([variable.size for variable in
-                                 graph.trainable_variables if 'embed' in variable.name]))
-    gather_param_count = int(sum([variable.size for variable in
-                                  graph.trainable_variables if 'gather' in variable.name]))
-    body_param_count = int(sum([variable.size for variable in
-                                graph.trainable_variables if 'body' in variable.name]))
+    # All counts and dimension names are gathered in one walk over the variables.
+    param_count = var_count = embed_param_count = gather_param_count = body_param_count = 0
+    dim_names = set()
+    for variable in graph.all_variables:
+        var_count += variable.size
+        dim_names.update(variable.shape.dimension_names)
+        if not variable.trainable:
+            continue
+        param_count += variable.size
+        embed_param_count += variable.size * ('embed' in variable.name)
+        gather_param_count += variable.size * ('gather' in variable.name)
+        body_param_count += variable.size * ('body' in variable.name)
 
     print('')
 
@@ -94,8 +96,7 @@ def analyze_model(params: ModelParameter, time_to_build: float, graph: mtf.Graph
         color_print(params, f'{name:<{max_str}s}{constant}{count:>{max_int}s}')
 
     color_print(params, "\nDimensions:")
-    for dim_name in sorted(list(set([item for variable in graph.all_variables
-                                     for item in variable.shape.dimension_names]))):
+    for dim_name in sorted(dim_names):
         color_print(params, dim_name)
     print('')
 
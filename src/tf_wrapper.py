@@ -138,3 +138,15 @@ def tf_range(start: int, end: int, step: int):
 
 def cast(tensor: tf.cast, dtype: tf.DType):
     return scoped("reshape", tf.cast, tensor, dtype)
+
+
+def reduce_sum(tensor: tf.Tensor, axis: int) -> tf.Tensor:
+    return scoped("reduce_sum", tf.reduce_sum, tensor, axis, keepdims=True)
+
+
+def reduce_max(tensor: tf.Tensor, axis: int) -> tf.Tensor:
+    return scoped("reduce_max", tf.reduce_max, tensor, axis, keepdims=True)
+
+
+def softmax(tensor: tf.Tensor, axis: int) -> tf.Tensor:
+    return scoped("softmax", tf.nn.softmax, tensor, axis)
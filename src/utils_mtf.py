@@ -192,7 +192,7 @@ def deduplicate(inp: SHAPE) -> SHAPE:
     :param inp: iterable to deduplicate
     :return: new, unique iterable of same type as input
     """
-    return type(inp)(dict.fromkeys(list(inp)))
+    return type(inp)(dict.fromkeys(inp))
 
 
 def gradient_iterator(params: ModelParameter, op: mtf.Operation, grad_outputs: typing.List[mtf.Tensor]
@@ -276,6 +276,7 @@ def get_variable(params: ModelParameter, name: str, shape: SHAPE, initializer: I
     shape = deduplicate(mtf.Shape(shape))
     var = mtf.Variable(params.mesh, name, shape, dtype, initializer, trainable)
     var.full_name = full_name
+    var.large_tensor = is_large_tensor(params, var)
     params.variable_cache[full_name] = params.mesh.graph.name_to_variable[full_name] = var
     return var.outputs[0]
 
@@ -353,12 +354,24 @@ def utils_slice(tensor: mtf.Tensor, start: int, end: int, dim: typing.Union[mtf.
 
 def feature_dims_used(params: ModelParameter, shape: typing.Union[SHAPE, mtf.Tensor, mtf.Variable],
                       dims: OPT_DIMS = None) -> bool:
-    if isinstance(shape, (mtf.Tensor, mtf.Variable)):
-        shape = shape.shape
+    shape = dims_from_shape(shape)
     if dims is None:
         dims = params.feature_dims + [anonymize_dim(dim) for dim in params.feature_dims]
-        return bool(sum(f in dims_from_shape(shape) for f in dims) // 2)
-    return all(f in dims_from_shape(shape) for f in dims)
+        return bool(sum(f in shape for f in dims) // 2)
+    return all(f in shape for f in dims)
+
+
+def is_large_tensor(params: ModelParameter, var: mtf.Variable) -> bool:
+    features_used = feature_dims_used(params, var)
+    large_tensor = features_used and len(var.shape.dims) > len(params.feature_dims)
+    large_tensor |= not features_used and len(var.shape.dims) >= 2  # not norm or rezero + scalable catch-all
+    large_tensor &= var.shape.size > 1  # not rezero
+    large_tensor &= "norm" not in var.name  # not norm
+    large_tensor &= "rezero" not in var.name  # not norm
+    large_tensor &= "embed" not in var.name  # not input/output embedding, position embedding, attention map bias
+    large_tensor &= "input" not in var.name or "lang_in" in var.name or "vid_in" in var.name  # not input
+    large_tensor &= "output" not in var.name or "lang_out" in var.name or "vid_out" in var.name  # not output
+    return large_tensor
 
 
 def dims_from_shape(shape: ALL_SHAPES) -> DIM_LIST:
@@ -24,8 +24,7 @@ class BaseTest:
         self.layout_rules = [] if layout_rules is None else layout_rules
         self.devices = ["cpu:0"] if devices is None else devices
 
-        self.session_config = tf1.ConfigProto()
-        self.session_config.allow_soft_placement = True
+        self.session_config = tf1.ConfigProto(allow_soft_placement=True)
 
     def _close_session(self):
         default_session = tf1.get_default_session()